@@ -2,22 +2,30 @@ import json
 import logging
 import os
 import boto3
-from datetime import datetime
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client("s3")
-OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET")
+BOTO_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True
+)
+
+s3_client = boto3.client("s3", config=BOTO_CONFIG)
+# Required setting, a missing value fails the Lambda init rather than each invocation
+OUTPUT_BUCKET = os.environ["OUTPUT_BUCKET"]
+METADATA_WORKERS = 32
 
 
 def lambda_handler(event, context):
     """Update status file in output bucket"""
-    logger.info(f"Received status update event: {json.dumps(event, indent=2)}")
-    
-    if not OUTPUT_BUCKET:
-        logger.error("OUTPUT_BUCKET environment variable not set")
-        return {"statusCode": 500, "body": "Configuration error"}
+    logger.info("Received status update for %s: %s", event.get("directory_path"), event.get("status"))
+    logger.debug("Received status update event: %s", event)
     
     try:
         directory_path = event["directory_path"]
@@ -26,17 +34,9 @@ def lambda_handler(event, context):
         execution_arn = event.get("execution_arn")
         error = event.get("error")
         
-        # Read current status to get total_files count
         status_key = f"{directory_path}_status.json"
-        current_status = {}
-        
-        try:
-            response = s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=status_key)
-            current_status = json.loads(response["Body"].read().decode("utf-8"))
-        except Exception as e:
-            logger.warning(f"Could not read current status file: {e}")
         
-        # Aggregate token usage from S3 metadata if status is completed
+        # Aggregate token usage from worker results if status is completed
         total_input_tokens = 0
         total_output_tokens = 0
         total_tokens = 0
@@ -45,91 +45,88 @@ def lambda_handler(event, context):
         
         if status == "completed":
             try:
-                # List all JSON files in the directory
-                response = s3_client.list_objects_v2(
-                    Bucket=OUTPUT_BUCKET,
-                    Prefix=directory_path
-                )
-                
-                if 'Contents' in response:
-                    for obj in response['Contents']:
-                        if obj['Key'].endswith('.json') and not obj['Key'].endswith('_status.json'):
-                            try:
-                                # Get metadata for each output file
-                                head_response = s3_client.head_object(
-                                    Bucket=OUTPUT_BUCKET,
-                                    Key=obj['Key']
-                                )
-                                
-                                metadata = head_response.get('Metadata', {})
-                                
-                                # Aggregate token counts
-                                total_input_tokens += int(metadata.get('input-tokens', 0))
-                                total_output_tokens += int(metadata.get('output-tokens', 0))
-                                total_tokens += int(metadata.get('total-tokens', 0))
-                                
-                                # Count success/failure
-                                if metadata.get('processing-status') == 'success':
-                                    successful_files += 1
-                                elif metadata.get('processing-status') == 'error':
-                                    failed_files += 1
-                                    
-                            except Exception as e:
-                                logger.warning(f"Could not read metadata for {obj['Key']}: {e}")
-                
+                result_writer_details = event.get("result_writer_details")
+                if result_writer_details:
+                    results = get_map_results(result_writer_details)
+                else:
+                    results = get_metadata_results(directory_path)
+
+                for result in results:
+                    # Aggregate token counts
+                    total_input_tokens += int(result.get('input_tokens', 0))
+                    total_output_tokens += int(result.get('output_tokens', 0))
+                    total_tokens += int(result.get('total_tokens', 0))
+
+                    # Count success/failure
+                    if result.get('status') == 'success':
+                        successful_files += 1
+                    elif result.get('status') == 'error':
+                        failed_files += 1
+
                 logger.info(f"Token usage aggregated - Input: {total_input_tokens}, Output: {total_output_tokens}, Total: {total_tokens}")
                 logger.info(f"File processing results - Successful: {successful_files}, Failed: {failed_files}")
                 
             except Exception as e:
                 logger.error(f"Error aggregating token usage: {e}")
         
-        # Update status data
-        status_data = {
-            "status": status,
-            "message": message,
-            "total_files": current_status.get("total_files", 0),
-            "completed_files": current_status.get("total_files", 0) if status == "completed" else current_status.get("completed_files", 0),
-            "timestamp": datetime.now().isoformat(),
-            "directory_path": directory_path,
-            "model_id": current_status.get("model_id")
-        }
+        for attempt in range(2):
+            # Read the current status and its ETag, so the write below can detect a concurrent update
+            current_status, etag = get_current_status(event, status_key)
+
+            # Update status data
+            status_data = {
+                "status": status,
+                "message": message,
+                "total_files": current_status.get("total_files", 0),
+                "completed_files": current_status.get("total_files", 0) if status == "completed" else current_status.get("completed_files", 0),
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "directory_path": directory_path,
+                "model_id": current_status.get("model_id")
+            }
         
-        # Add detailed results if we have them
-        if status == "completed" and (successful_files > 0 or failed_files > 0):
-            status_data["successful_files"] = successful_files
-            status_data["failed_files"] = failed_files
+            # Add detailed results if we have them
+            if status == "completed" and (successful_files > 0 or failed_files > 0):
+                status_data["successful_files"] = successful_files
+                status_data["failed_files"] = failed_files
             
-            # Add token usage if we have any
-            if total_tokens > 0:
-                token_usage = {
-                    "input_tokens": total_input_tokens,
-                    "output_tokens": total_output_tokens,
-                    "total_tokens": total_tokens
-                }
+                # Add token usage if we have any
+                if total_tokens > 0:
+                    token_usage = {
+                        "input_tokens": total_input_tokens,
+                        "output_tokens": total_output_tokens,
+                        "total_tokens": total_tokens
+                    }
                 
-                # Add average token metrics per successful file
-                if successful_files > 0:
-                    token_usage["avg_input_tokens_per_file"] = round(total_input_tokens / successful_files, 2)
-                    token_usage["avg_output_tokens_per_file"] = round(total_output_tokens / successful_files, 2)
-                    token_usage["avg_total_tokens_per_file"] = round(total_tokens / successful_files, 2)
+                    # Add average token metrics per successful file
+                    if successful_files > 0:
+                        token_usage["avg_input_tokens_per_file"] = round(total_input_tokens / successful_files, 2)
+                        token_usage["avg_output_tokens_per_file"] = round(total_output_tokens / successful_files, 2)
+                        token_usage["avg_total_tokens_per_file"] = round(total_tokens / successful_files, 2)
                 
-                status_data["token_usage"] = token_usage
+                    status_data["token_usage"] = token_usage
         
-        if execution_arn:
-            status_data["execution_arn"] = execution_arn
+            if execution_arn:
+                status_data["execution_arn"] = execution_arn
             
-        if error:
-            status_data["error"] = error
-        
-        # Write updated status file
-        s3_client.put_object(
-            Bucket=OUTPUT_BUCKET,
-            Key=status_key,
-            Body=json.dumps(status_data, indent=2),
-            ContentType='application/json'
-        )
+            if error:
+                status_data["error"] = error
         
-        logger.info(f"Updated status file: s3://{OUTPUT_BUCKET}/{status_key} to {status}")
+            # Write updated status file, only if it hasn't changed since it was read
+            put_args = {"IfMatch": etag} if etag else {}
+            try:
+                s3_client.put_object(
+                    Bucket=OUTPUT_BUCKET,
+                    Key=status_key,
+                    Body=json.dumps(status_data, indent=2),
+                    ContentType='application/json',
+                    **put_args
+                )
+                logger.info(f"Updated status file: s3://{OUTPUT_BUCKET}/{status_key} to {status}")
+                break
+            except ClientError as e:
+                if attempt or e.response['Error']['Code'] != 'PreconditionFailed':
+                    raise
+                logger.warning(f"Status file {status_key} changed while updating, retrying")
         
         return {
             "statusCode": 200,
@@ -144,4 +141,90 @@ def lambda_handler(event, context):
         return {
             "statusCode": 500,
             "body": json.dumps({"error": str(e)})
-        }
\ No newline at end of file
+        }
+
+
+def get_current_status(event, status_key):
+    """Get the current status fields and the ETag to guard the update with"""
+    try:
+        response = s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=status_key)
+        current_status, etag = json.load(response["Body"]), response["ETag"]
+    except Exception as e:
+        logger.warning(f"Could not read current status file: {e}")
+        current_status, etag = {}, None
+
+    # The state machine passes the counts the job started with, which also cover a missing file
+    for field in ("total_files", "model_id"):
+        if field in event:
+            current_status[field] = event[field]
+
+    return current_status, etag
+
+
+def get_map_results(result_writer_details):
+    """Read worker results from the Distributed Map ResultWriter manifest"""
+    bucket = result_writer_details["Bucket"]
+    manifest = read_json_object(bucket, result_writer_details["Key"])
+
+    result_files = manifest.get("ResultFiles", {})
+    result_keys = [
+        result_file["Key"]
+        for result_file in result_files.get("SUCCEEDED", []) + result_files.get("FAILED", [])
+    ]
+
+    results = []
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        for executions in executor.map(lambda key: read_json_object(bucket, key), result_keys):
+            for execution in executions:
+                if execution.get("Status") == "SUCCEEDED" and execution.get("Output"):
+                    output = json.loads(execution["Output"])
+                    results.extend(output.get("results", [output]))
+                else:
+                    # Worker invocation itself failed, so count every file in its batch as an error
+                    items = json.loads(execution.get("Input") or "{}").get("Items", [None])
+                    results.extend({"status": "error"} for _ in items)
+
+    return results
+
+
+def get_metadata_results(directory_path):
+    """Read worker results from the S3 metadata of each output file"""
+    # Outputs sit directly under the directory, so the delimiter keeps
+    # any nested prefixes out of the listing
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=OUTPUT_BUCKET, Prefix=directory_path, Delimiter='/')
+    skip_keys = {f"{directory_path}_status.json", f"{directory_path}_batch_input.json"}
+
+    output_keys = [
+        obj['Key']
+        for page in pages
+        for obj in page.get('Contents', [])
+        if obj['Key'].endswith('.json') and obj['Key'] not in skip_keys
+    ]
+
+    # Fetch metadata for all output files in parallel
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        return list(executor.map(get_output_metadata, output_keys))
+
+
+def get_output_metadata(key):
+    """Get token usage for a single output file from its S3 metadata, empty if it can't be read"""
+    try:
+        head_response = s3_client.head_object(Bucket=OUTPUT_BUCKET, Key=key)
+    except Exception as e:
+        logger.warning(f"Could not read metadata for {key}: {e}")
+        return {}
+
+    metadata = head_response.get('Metadata', {})
+    return {
+        "status": metadata.get('processing-status'),
+        "input_tokens": metadata.get('input-tokens', 0),
+        "output_tokens": metadata.get('output-tokens', 0),
+        "total_tokens": metadata.get('total-tokens', 0)
+    }
+
+
+def read_json_object(bucket, key):
+    """Read and parse a JSON object from S3"""
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return json.load(response["Body"])
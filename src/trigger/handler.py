@@ -1,152 +1,177 @@
+import io
 import json
 import logging
 import os
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from urllib.parse import unquote_plus
-from datetime import datetime
+from datetime import datetime, timezone
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client("s3")
-bedrock_client = boto3.client("bedrock", region_name="us-east-1")
-stepfunctions_client = boto3.client("stepfunctions", region_name="us-east-1")
-OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET")
-STATE_MACHINE_ARN = os.environ.get("STATE_MACHINE_ARN")
+BOTO_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True
+)
+
+s3_client = boto3.client("s3", config=BOTO_CONFIG)
+stepfunctions_client = boto3.client("stepfunctions", region_name="us-east-1", config=BOTO_CONFIG)
+# Required settings, missing values fail the Lambda init rather than each invocation
+OUTPUT_BUCKET = os.environ["OUTPUT_BUCKET"]
+STATE_MACHINE_ARN = os.environ["STATE_MACHINE_ARN"]
 MODEL_ID = os.environ.get("MODEL_ID")
-SUPPORTED_EXTENSIONS = [".png", ".jpg", ".jpeg", ".gif", ".webp", ".pdf", ".tiff", ".tif"]
+RECORD_WORKERS = 10
+BATCH_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=10)
+SUPPORTED_EXTENSIONS = frozenset({"png", "jpg", "jpeg", "gif", "webp", "pdf", "tiff", "tif"})
+RECORD_ID_TRANSLATION = str.maketrans({"/": "-", ".": "-"})
 
 
 def lambda_handler(event, context):
-    logger.info("Received event: %s" % json.dumps(event, indent=2))
+    logger.debug("Received event: %s", event)
 
-    # Validate required environment variables
-    if not OUTPUT_BUCKET:
-        logger.error("OUTPUT_BUCKET environment variable not set")
-        return {"statusCode": 500, "body": "Configuration error"}
-    if not STATE_MACHINE_ARN:
-        logger.error("STATE_MACHINE_ARN environment variable not set")
-        return {"statusCode": 500, "body": "Configuration error"}
+    # Records are independent, so process them concurrently
+    with ThreadPoolExecutor(max_workers=RECORD_WORKERS) as executor:
+        list(executor.map(process_record, event["Records"]))
 
-    for record in event["Records"]:
-        bucket = record["s3"]["bucket"]["name"]
-        key = unquote_plus(record["s3"]["object"]["key"])
-
-        logger.info(f"Processing: bucket={bucket}, key={key}")
-
-        try:
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            file_content = response["Body"].read().decode("utf-8")
-            prompt_config = json.loads(file_content)
-
-            print(f"prompt config: {prompt_config}")
+    return {"statusCode": 200, "body": "success"}
 
-            if "prompt" not in prompt_config:
-                raise ValueError("Missing required field: 'prompt'")
 
-            # Validate directory depth and build directory path
-            key_parts = key.split("/")
-            directory_path = "/".join(key_parts[:-1])
-            if directory_path:
-                directory_path += "/"
-            
-            # Must be exactly one level deep
-            if len(key_parts) != 2:
-                error_msg = f"Invalid directory structure. Expected exactly one level deep (folder/_prompt.json), got: {key}"
-                logger.error(error_msg)
-                create_status_file(directory_path, "error", error_msg, 0, 0)
-                continue
+def process_record(record):
+    """Validate a single _prompt.json upload and start processing its directory"""
+    bucket = record["s3"]["bucket"]["name"]
+    key = unquote_plus(record["s3"]["object"]["key"])
 
-            # Check if output directory already exists (job already running/completed)
-            if check_output_directory_exists(directory_path):
-                logger.info(f"Output directory already exists for {directory_path}, skipping job")
-                create_status_file(directory_path, "error", f"Job output already exists for {directory_path}, Delete this directory and retry", 0, 0)
-                continue
+    logger.info(f"Processing: bucket={bucket}, key={key}")
 
-            files = list_files_in_directory(bucket, directory_path)
-            logger.info(f"Found {len(files)} processable files")
+    try:
+        # S3 events carry the object's ETag, so an unchanged prompt is served from the cache.
+        # Without one (hand-built or replayed events) a re-uploaded prompt can't be told apart, so always read it
+        etag = record["s3"]["object"].get("eTag")
+        if etag:
+            prompt_config = load_prompt_config(bucket, key, etag)
+        else:
+            prompt_config = read_prompt_config(bucket, key)
+
+        logger.debug("Prompt config: %s", prompt_config)
+
+        if "prompt" not in prompt_config:
+            raise ValueError("Missing required field: 'prompt'")
+
+        # Validate directory depth and build directory path
+        key_parts = key.split("/")
+        directory_path = "/".join(key_parts[:-1])
+        if directory_path:
+            directory_path += "/"
+        
+        # Must be exactly one level deep
+        if len(key_parts) != 2:
+            error_msg = f"Invalid directory structure. Expected exactly one level deep (folder/_prompt.json), got: {key}"
+            logger.error(error_msg)
+            create_status_file(directory_path, "error", error_msg, 0, 0)
+            return
+
+        # Check if output directory already exists (job already running/completed)
+        if check_output_directory_exists(directory_path):
+            logger.info(f"Output directory already exists for {directory_path}, skipping job")
+            create_status_file(directory_path, "error", f"Job output already exists for {directory_path}, Delete this directory and retry", 0, 0)
+            return
+
+        files = list_files_in_directory(bucket, directory_path)
+        logger.info(f"Found {len(files)} processable files")
+
+        if not files:
+            logger.info("No processable files found in directory.")
+            create_status_file(directory_path, "error", "No processable files found", 0, 0)
+            return
+
+        batch_records = create_batch_records(files, prompt_config, bucket)
+        batch_file_key = f"{directory_path}_batch_input.json"
+
+        # Large batch files are uploaded in parallel multipart chunks
+        s3_client.upload_fileobj(
+            create_batch_file(batch_records),
+            OUTPUT_BUCKET,
+            batch_file_key,
+            ExtraArgs={"ContentType": "application/json"},
+            Config=BATCH_TRANSFER_CONFIG
+        )
 
-            if not files:
-                logger.info("No processable files found in directory.")
-                create_status_file(directory_path, "error", "No processable files found", 0, 0)
-                continue
+        logger.info(f"Created batch input file: s3://{OUTPUT_BUCKET}/{batch_file_key}")
 
-            batch_records = create_batch_records(files, prompt_config, bucket)
-            batch_file_key = f"{directory_path}_batch_input.json"
+        execution_name = f"ai-processor-{directory_path.replace('/', '-')}-{int(datetime.now().timestamp())}"
 
-            s3_client.put_object(
-                Bucket=OUTPUT_BUCKET,
-                Key=batch_file_key,
-                Body=json.dumps(batch_records),
-                ContentType='application/json'
-            )
+        step_functions_input = {
+            "batch_file_key": batch_file_key,
+            "directory_path": directory_path,
+            "output_bucket": OUTPUT_BUCKET,
+            "total_files": len(files),
+            "model_id": MODEL_ID,
+        }
 
-            logger.info(f"Created batch input file: s3://{OUTPUT_BUCKET}/{batch_file_key}")
+        response = stepfunctions_client.start_execution(
+            stateMachineArn=STATE_MACHINE_ARN,
+            name=execution_name,
+            input=json.dumps(step_functions_input)
+        )
 
-            execution_name = f"ai-processor-{directory_path.replace('/', '-')}-{int(datetime.now().timestamp())}"
+        execution_arn = response['executionArn']
+        logger.info(f"Started Step Functions execution: {execution_arn}")
 
-            step_functions_input = {
-                "batch_file_key": batch_file_key,
-                "directory_path": directory_path,
-                "output_bucket": OUTPUT_BUCKET,
-            }
+        create_status_file(directory_path, "in_progress", f"Processing {len(files)} files", len(files), 0, execution_arn)
 
-            response = stepfunctions_client.start_execution(
-                stateMachineArn=STATE_MACHINE_ARN,
-                name=execution_name,
-                input=json.dumps(step_functions_input)
-            )
+    except Exception as e:
+        logger.error(f"Error processing {key}: {e}")
+        # Try to create error status file if we can determine directory path
+        try:
+            directory_path = "/".join(key.split("/")[:-1])
+            if directory_path:
+                directory_path += "/"
+            create_status_file(directory_path, "error", f"Processing failed: {str(e)}", 0, 0)
+        except Exception:
+            pass  # Don't fail if we can't create status file
 
-            execution_arn = response['executionArn']
-            logger.info(f"Started Step Functions execution: {execution_arn}")
 
-            create_status_file(directory_path, "in_progress", f"Processing {len(files)} files", len(files), 0, execution_arn)
+@lru_cache(maxsize=64)
+def load_prompt_config(bucket, key, etag):
+    """Read a _prompt.json, cached per ETag across warm invocations"""
+    return read_prompt_config(bucket, key)
 
-        except Exception as e:
-            logger.error(f"Error processing {key}: {e}")
-            # Try to create error status file if we can determine directory path
-            try:
-                directory_path = "/".join(key.split("/")[:-1])
-                if directory_path:
-                    directory_path += "/"
-                create_status_file(directory_path, "error", f"Processing failed: {str(e)}", 0, 0)
-            except Exception:
-                pass  # Don't fail if we can't create status file
 
-    return {"statusCode": 200, "body": "success"}
+def read_prompt_config(bucket, key):
+    """Read and parse a _prompt.json from S3"""
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return json.load(response["Body"])
 
 
 def list_files_in_directory(bucket, directory_path):
     files = []
 
     try:
-        response = s3_client.list_objects_v2(Bucket=bucket, Prefix=directory_path)
-        if "Contents" not in response:
-            logger.info("No files in directory")
-
-        for obj in response["Contents"]:
+        for obj in iter_objects(bucket, directory_path):
             key = obj["Key"]
 
-            if (
-                key.endswith("_prompt.json")
-                or key.endswith(".json")
-                or key.endswith("/")
-            ):
+            if key.endswith("/"):
                 continue
 
-            _, ext = os.path.splitext(key)
-            if ext.lower() not in SUPPORTED_EXTENSIONS:
+            ext = key.rpartition(".")[2].lower()
+            if ext == "json":
+                continue
+            if ext not in SUPPORTED_EXTENSIONS:
                 logger.warning(f"Unsupported file format for {key}, skipping.")
                 continue
 
-            format, content_type = get_file_format_and_content_type(key)
-
+            # PDFs are documents, everything else is an image
             files.append(
                 {
                     "key": key,
-                    "format": format,
-                    "content_type": content_type,
+                    "format": ext,
+                    "content_type": "document" if ext == "pdf" else "image",
                     "size": obj["Size"],
                 }
             )
@@ -157,18 +182,15 @@ def list_files_in_directory(bucket, directory_path):
     return files
 
 
-def get_file_format_and_content_type(file_key):
-    _, ext = os.path.splitext(file_key)
-    file_format = ext.lower()[1:]
-
-    # Determine content type - PDFs are documents, others are images
-    content_type = "document" if file_format == "pdf" else "image"
-
-    return file_format, content_type
+def iter_objects(bucket, prefix):
+    """Yield every object under prefix, following list_objects_v2 pagination"""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}):
+        yield from page.get("Contents", [])
 
 
 def create_processing_record(file_info, prompt_config, bucket):
-    record_id = f"{file_info['key'].replace('/', '-').replace('.', '-')}"
+    record_id = file_info["key"].translate(RECORD_ID_TRANSLATION)
 
     return {
         "recordId": record_id,
@@ -195,6 +217,21 @@ def create_batch_records(files, prompt_config, bucket):
     return records
 
 
+def create_batch_file(batch_records):
+    """Serialize batch records as a JSON array straight into an in-memory file"""
+    batch_file = io.BytesIO()
+    batch_file.write(b"[")
+
+    for index, record in enumerate(batch_records):
+        if index:
+            batch_file.write(b",")
+        batch_file.write(json.dumps(record).encode("utf-8"))
+
+    batch_file.write(b"]")
+    batch_file.seek(0)
+    return batch_file
+
+
 def check_output_directory_exists(directory_path):
     """Check if output directory already exists in output bucket"""
     try:
@@ -205,7 +242,7 @@ def check_output_directory_exists(directory_path):
             MaxKeys=1
         )
 
-        logger.info(f"Directory check response: {response}")
+        logger.debug("Directory check response: %s", response)
         
         # If any objects exist with this prefix, directory exists
         return 'Contents' in response and len(response['Contents']) > 0
@@ -225,7 +262,7 @@ def create_status_file(directory_path, status, message, total_files, completed_f
         "message": message,
         "total_files": total_files,
         "completed_files": completed_files,
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
         "directory_path": directory_path,
         "model_id": MODEL_ID
     }
@@ -1,20 +1,53 @@
 import json
 import logging
 import os
+import re
 import boto3
-from datetime import datetime
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from PIL import Image
 import io
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-bedrock_runtime = boto3.client('bedrock-runtime')
-s3_client = boto3.client('s3')
+BOTO_CONFIG = Config(
+    max_pool_connections=20,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=60
+)
+# Long transcriptions can take minutes to generate, so allow up to the worker timeout
+BEDROCK_CONFIG = BOTO_CONFIG.merge(Config(read_timeout=300))
+
+bedrock_runtime = boto3.client('bedrock-runtime', config=BEDROCK_CONFIG)
+s3_client = boto3.client('s3', config=BOTO_CONFIG)
 
 MODEL_ID = os.environ.get('MODEL_ID')
 
+# Patterns for sanitize_pdf_filename
+WHITESPACE_PATTERN = re.compile(r'\s+')
+PDF_NAME_DISALLOWED_PATTERN = re.compile(r'[^a-zA-Z0-9 \-\(\)\[\]]')
+
+# Time one record can take (the Bedrock read timeout plus S3 reads and writes);
+# records of a batch are only started while at least this much of the invocation remains
+RECORD_TIME_BUDGET_MS = 330 * 1000
+
+# Image formats the Converse API accepts directly, and modes safe to send without conversion
+PASSTHROUGH_IMAGE_FORMATS = frozenset({'PNG', 'JPEG', 'GIF', 'WEBP'})
+PASSTHROUGH_IMAGE_MODES = frozenset({'RGB', 'RGBA', 'L', 'LA', 'P'})
+
+# Image modes written to PNG without conversion
+PNG_NATIVE_MODES = frozenset({'1', 'L', 'LA', 'RGB', 'RGBA'})
+
+# Prepared file bytes kept across warm invocations, keyed by (bucket, key)
+PREPARED_FILE_CACHE_SIZE = 8
+prepared_file_cache = OrderedDict()
+prepared_file_cache_lock = threading.Lock()
+
 # Tool configuration for transcription
 TRANSCRIPTION_TOOL_CONFIG = {
     "tools": [
@@ -53,15 +86,17 @@ def get_image_format(filename):
     """
     Get image format for Converse API based on file extension.
 
-    All images are converted to PNG. PDFs remain as documents.
+    Images default to PNG, the format they are converted to unless already
+    usable as is. PDFs remain as documents.
 
     Args:
         filename: The file path/name
 
     Returns:
-        str: Image/document format for Converse API ('png' or 'pdf')
+        str: 'pdf' for documents, otherwise 'png'; images sent as is keep
+        their own format ('jpeg', 'gif' or 'webp'), see convert_and_resize_image
     """
-    extension = filename.lower().split('.')[-1]
+    extension = filename.rpartition('.')[2].lower()
     # PDFs stay as PDF, everything else becomes PNG
     return 'pdf' if extension == 'pdf' else 'png'
 
@@ -78,67 +113,119 @@ def sanitize_pdf_filename(filename):
     Returns:
         str: Sanitized filename without extension (e.g., "document")
     """
-    import re
     # Remove file extension (everything after last dot)
     name_without_ext = filename.rsplit('.', 1)[0] if '.' in filename else filename
 
     # Replace consecutive whitespace with single space
-    sanitized = re.sub(r'\s+', ' ', name_without_ext)
+    sanitized = WHITESPACE_PATTERN.sub(' ', name_without_ext)
     # Remove any characters that aren't alphanumeric, space, hyphen, parentheses, or square brackets
-    sanitized = re.sub(r'[^a-zA-Z0-9 \-\(\)\[\]]', '_', sanitized)
+    sanitized = PDF_NAME_DISALLOWED_PATTERN.sub('_', sanitized)
     # Clean up any resulting consecutive spaces again
-    sanitized = re.sub(r'\s+', ' ', sanitized)
+    sanitized = WHITESPACE_PATTERN.sub(' ', sanitized)
     return sanitized.strip()
 
 def convert_and_resize_image(file_data, filename, max_dimension=1000):
     """
     Convert any image to PNG and resize to max dimension of 1000px.
 
+    Images already in a format the Converse API accepts and within the max
+    dimension are returned unchanged.
+
     Args:
         file_data: Raw image bytes
         filename: Original filename for logging
         max_dimension: Maximum width or height in pixels (default: 1000)
 
     Returns:
-        bytes: PNG image data resized to max dimension
+        tuple: (image bytes, Converse API image format: 'png', 'jpeg', 'gif' or 'webp')
     """
-    logger.info(f"Converting {filename} to PNG with max dimension {max_dimension}px")
+    # Imported here so PDF-only containers never pay Pillow's import cost
+    from PIL import Image
 
-    # Open image with Pillow
+    # Open image with Pillow, this only reads the header
     img = Image.open(io.BytesIO(file_data))
     original_width, original_height = img.size
 
-    # Calculate new dimensions maintaining aspect ratio
-    if original_width > max_dimension or original_height > max_dimension:
-        if original_width > original_height:
-            new_width = max_dimension
-            new_height = int(original_height * (max_dimension / original_width))
-        else:
-            new_height = max_dimension
-            new_width = int(original_width * (max_dimension / original_height))
+    if (
+        img.format in PASSTHROUGH_IMAGE_FORMATS
+        and img.mode in PASSTHROUGH_IMAGE_MODES
+        and original_width <= max_dimension
+        and original_height <= max_dimension
+    ):
+        logger.info(f"Image {filename} is {img.format} {original_width}x{original_height}, sending as is")
+        return file_data, img.format.lower()
 
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        logger.info(f"Resized from {original_width}x{original_height} to {new_width}x{new_height}")
+    logger.info(f"Converting {filename} to PNG with max dimension {max_dimension}px")
+
+    if original_width > max_dimension or original_height > max_dimension:
+        # thumbnail keeps the aspect ratio, and for JPEGs first lets libjpeg
+        # decode at 1/2, 1/4 or 1/8 scale so fewer pixels reach LANCZOS
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        logger.info(f"Resized from {original_width}x{original_height} to {img.width}x{img.height}")
     else:
-        new_width, new_height = original_width, original_height
         logger.info(f"Image {original_width}x{original_height} is within max dimension, no resize needed")
 
-    # Convert to RGB if needed (PNG supports RGBA, but this handles any edge cases)
-    if img.mode in ('RGBA', 'LA'):
-        # Keep transparency for PNG
+    # Convert to the cheapest mode PNG can store without losing detail
+    if img.mode == 'P':
+        # Only keep an alpha channel when the palette actually has transparency
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    elif img.mode in PNG_NATIVE_MODES:
+        # PNG stores these directly, grayscale and bilevel stay smaller than RGB
         pass
-    elif img.mode == 'P':
-        img = img.convert('RGBA')
-    elif img.mode not in ('RGB', 'RGBA'):
+    else:
+        # CMYK, YCbCr, 16/32-bit and other modes
         img = img.convert('RGB')
 
-    # Save as PNG
-    output = io.BytesIO()
-    img.save(output, format='PNG', optimize=True)
-    output_data = output.getvalue()
+    # Save as PNG; getvalue() hands over the buffer without copying when nothing else holds it
+    with io.BytesIO() as output:
+        # Default zlib level; optimize=True costs seconds on large pages for a few saved bytes
+        img.save(output, format='PNG', compress_level=6)
+        output_data = output.getvalue()
 
     logger.info(f"Converted to PNG: {len(file_data)} bytes -> {len(output_data)} bytes")
-    return output_data
+    return output_data, 'png'
+
+def get_prepared_file(bucket, file_key, file_format):
+    """
+    Get file bytes ready for the Converse API, reusing the copy prepared by
+    an earlier warm invocation while the S3 object's ETag is unchanged.
+
+    Args:
+        bucket: Source S3 bucket
+        file_key: Source S3 key
+        file_format: Converse API format from get_image_format
+
+    Returns:
+        tuple: (file bytes, Converse API format: 'pdf', 'png', 'jpeg', 'gif' or 'webp'),
+        images resized to max 1000px
+    """
+    cache_key = (bucket, file_key)
+    with prepared_file_cache_lock:
+        cached = prepared_file_cache.get(cache_key)
+
+    # Conditional GET: S3 answers 304 without a body if the cached copy is current
+    get_args = {'IfNoneMatch': cached[0]} if cached else {}
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=file_key, **get_args)
+    except ClientError as e:
+        if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+            logger.info(f"Using cached copy of s3://{bucket}/{file_key}")
+            return cached[1], cached[2]
+        raise
+
+    file_data = response['Body'].read()
+
+    if file_format != 'pdf':
+        # Convert images to PNG with max 1000px dimension unless already usable
+        file_data, file_format = convert_and_resize_image(file_data, file_key)
+
+    with prepared_file_cache_lock:
+        prepared_file_cache[cache_key] = (response['ETag'], file_data, file_format)
+        prepared_file_cache.move_to_end(cache_key)
+        while len(prepared_file_cache) > PREPARED_FILE_CACHE_SIZE:
+            prepared_file_cache.popitem(last=False)
+
+    return file_data, file_format
 
 def extract_tool_response(response, expected_tool_name):
     """
@@ -204,12 +291,49 @@ def validate_transcription_data(data):
     return True
 
 def lambda_handler(event, context):
-    logger.info(f"Processing file: {json.dumps(event, indent=2)}")
+    logger.debug("Processing file: %s", event)
+
+    output_bucket = event['output_bucket']
 
-    try: 
-        record = event['record']
-        output_bucket = event['output_bucket']
+    # Step Functions sends a batch of records, single-record events are still accepted
+    if 'records' in event:
+        return {
+            "statusCode": 200,
+            "results": process_batch(event['records'], output_bucket, context)
+        }
 
+    return process_record(event['record'], output_bucket)
+
+def process_batch(records, output_bucket, context):
+    """Process a batch of records one at a time, returning one result per record in order"""
+    results = []
+    for record in records:
+        # Fail the rest of the batch up front rather than letting Lambda time out mid-record
+        if context and context.get_remaining_time_in_millis() < RECORD_TIME_BUDGET_MS:
+            results.append(fail_record_out_of_time(record, output_bucket))
+        else:
+            results.append(process_record(record, output_bucket))
+    return results
+
+def fail_record_out_of_time(record, output_bucket):
+    """Record an error for a file the invocation has no time left to process"""
+    file_key = record.get('file_key', 'unknown')
+    record_id = record.get('recordId', 'unknown')
+    error_message = "Not enough time left in the worker invocation to process this file"
+
+    logger.error(f"Skipping {record_id}: {error_message}")
+
+    output_key = write_error_file(s3_client, output_bucket, file_key, record_id, "TimeBudgetExceeded", error_message)
+    return create_error_response(record_id, file_key, output_key, "TimeBudgetExceeded", error_message)
+
+def prepare_record_file(record):
+    """Get the prepared file bytes and Converse API format for a record"""
+    file_key = record['file_key']
+    return get_prepared_file(record['bucket'], file_key, get_image_format(file_key))
+
+def process_record(record, output_bucket):
+    """Run a single file through Bedrock and write its result to the output bucket"""
+    try:
         file_key = record['file_key']
         bucket = record['bucket']
         record_id = record['recordId']
@@ -217,14 +341,10 @@ def lambda_handler(event, context):
         max_tokens = record.get('max_tokens', 8192)
         temperature = 0
 
-        logger.info(f"Processing s3://{bucket}/{file_key}")
+        logger.info("Processing record %s key s3://%s/%s", record_id, bucket, file_key)
 
-        # Get file data
-        response = s3_client.get_object(Bucket=bucket, Key=file_key)
-        file_data = response['Body'].read()
-
-        # Determine format for Converse API
-        file_format = get_image_format(file_key)
+        # Get file data and its format for Converse API, images are resized when needed
+        file_data, file_format = prepare_record_file(record)
 
         # Build content block - PDFs use "document", others use "image"
         # Boto3 SDK handles base64 encoding automatically
@@ -241,9 +361,6 @@ def lambda_handler(event, context):
                 }
             }
         else:
-            # Convert all images to PNG with max 1000px dimension
-            file_data = convert_and_resize_image(file_data, file_key)
-
             media_content = {
                 "image": {
                     "format": file_format,
@@ -291,7 +408,7 @@ def lambda_handler(event, context):
         s3_client.put_object(
             Bucket=output_bucket,
             Key=output_key,
-            Body=json.dumps(transcription_data, indent=2, ensure_ascii=False),
+            Body=json.dumps(transcription_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
             ContentType='application/json',
             Metadata={
                 'record-id': record_id,
@@ -308,7 +425,9 @@ def lambda_handler(event, context):
             "recordId": record_id,
             "file_key": file_key,
             "output_key": output_key,
-            # "tokens_used": response['usage']['totalTokens'],
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
             "status": "success"
         }
 
@@ -361,14 +480,14 @@ def write_error_file(s3_client, output_bucket, file_key, record_id, error_code,
         "error_message": error_message,
         "file_key": file_key,
         "record_id": record_id,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds")
     }
     
     try:
         s3_client.put_object(
             Bucket=output_bucket,
             Key=output_key,
-            Body=json.dumps(error_result, indent=2),
+            Body=json.dumps(error_result, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
             ContentType='application/json',
             Metadata={
                 'record-id': record_id,
@@ -392,6 +511,9 @@ def create_error_response(record_id, file_key, output_key, error_code, error_mes
         "recordId": record_id,
         "file_key": file_key,
         "output_key": output_key,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "total_tokens": 0,
         "status": "error",
         "error_code": error_code,
         "error_message": error_message
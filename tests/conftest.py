@@ -0,0 +1,17 @@
+import os
+import sys
+
+# Set environment variables before any test module imports a handler
+os.environ['OUTPUT_BUCKET'] = "output-bucket-test"
+os.environ['STATE_MACHINE_ARN'] = 'arn:aws:states:us-east-1:123456789012:stateMachine:test-machine'
+os.environ['BEDROCK_ROLE_ARN'] = 'arn:1234567'
+os.environ['MODEL_ID'] = 'model_id'
+
+# Dummy credentials keep the real boto3 clients offline: botocore never walks the
+# credential chain or queries instance metadata, and nothing can reach a real account
+os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+os.environ['AWS_SESSION_TOKEN'] = 'testing'
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'trigger'))
@@ -1,33 +1,70 @@
+import io
 import json
 import pytest
-from unittest.mock import patch, MagicMock
-import sys
+from botocore.stub import Stubber
+from types import SimpleNamespace
+from unittest.mock import patch, DEFAULT, Mock
 import os
 
-# Set environment variables before importing handler
-os.environ['OUTPUT_BUCKET'] = "output-bucket-test" 
-os.environ['STATE_MACHINE_ARN'] = 'arn:aws:states:us-east-1:123456789012:stateMachine:test-machine'
-os.environ['BEDROCK_ROLE_ARN'] = 'arn:1234567'
-os.environ['MODEL_ID'] = 'model_id'
+import handler
+from handler import (
+    lambda_handler,
+    create_batch_file,
+    create_processing_record,
+    list_files_in_directory,
+    load_prompt_config,
+)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+@pytest.fixture(scope='class')
+def aws_mocks():
+    """Patch the handler's AWS client methods once per test class"""
+    # Plain Mocks suffice, the handler only calls these and reads the result
+    with patch.multiple(handler.s3_client, new_callable=Mock, get_object=DEFAULT, list_objects_v2=DEFAULT,
+                        put_object=DEFAULT, upload_fileobj=DEFAULT) as s3_mocks, \
+         patch.object(handler.stepfunctions_client, 'start_execution', new_callable=Mock) as start_execution:
+        yield SimpleNamespace(**s3_mocks, start_execution=start_execution)
 
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'trigger'))
-from handler import lambda_handler
 
 class TestLambdaHandler:
+
+    # Raw fixture contents, read from disk once per session
+    _fixture_cache = {}
+
+    def setup_method(self):
+        load_prompt_config.cache_clear()
+
+    @pytest.fixture(autouse=True)
+    def mock_aws(self, aws_mocks):
+        """Hand each test the shared mocks and reset them afterwards"""
+        yield aws_mocks
+        for mock in vars(aws_mocks).values():
+            mock.reset_mock(return_value=True, side_effect=True)
     
+    def load_fixture_bytes(self, filename):
+        if filename not in self._fixture_cache:
+            with open(os.path.join(FIXTURE_DIR, filename), 'rb') as f:
+                self._fixture_cache[filename] = f.read()
+        return self._fixture_cache[filename]
+
     def load_fixture(self, filename):
-        fixture_path = os.path.join(os.path.dirname(__file__), 'fixtures', filename)
-        with open(fixture_path, 'r') as f:
-            return json.load(f)
+        # Parse on every call so tests can mutate the result freely
+        return json.loads(self.load_fixture_bytes(filename))
+
+    def record_status_puts(self, mock_aws):
+        """Collect the contents of every _status.json written through put_object"""
+        status_puts = []
+        mock_aws.put_object.side_effect = lambda **kwargs: (
+            status_puts.append(json.loads(kwargs['Body'])) if kwargs['Key'].endswith('_status.json') else None
+        )
+        return status_puts
     
-    def test_lambda_handler_success(self):
+    def test_lambda_handler_success(self, mock_aws):
         event = self.load_fixture('s3_event.json')
-        sample_prompt = self.load_fixture('sample_prompt.json')
         
-        mock_response = {
-            'Body': MagicMock()
-        }
-        mock_response['Body'].read.return_value = json.dumps(sample_prompt).encode('utf-8')
+        mock_response = {'Body': io.BytesIO(self.load_fixture_bytes('sample_prompt.json'))}
         
         # Mock list_objects_v2 to return some files
         mock_list_response = {
@@ -36,93 +73,61 @@ class TestLambdaHandler:
                 {'Key': 'image2.png', 'Size': 2048}
             ]
         }
-        
-        with patch('handler.s3_client.get_object') as mock_get_object, \
-             patch('handler.s3_client.list_objects_v2') as mock_list, \
-             patch('handler.s3_client.put_object') as mock_put, \
-             patch('handler.stepfunctions_client.start_execution') as mock_step:
-            
-            mock_get_object.return_value = mock_response
-            # Mock different responses for different calls
-            mock_list.side_effect = [
-                {},  # First call: output directory check (no existing files - no Contents key)
-                mock_list_response  # Second call: input directory file listing
-            ]
-            mock_step.return_value = {'executionArn': 'arn:aws:states:execution'}
-            
-            result = lambda_handler(event, {})
-            
-            assert result['statusCode'] == 200
-            assert result['body'] == 'success'
-            mock_get_object.assert_called_once_with(
-                Bucket='test-ai-file-processor-input',
-                Key='test-folder/_prompt.json'
-            )
-            
-            # Verify status file was created
-            status_put_calls = [call for call in mock_put.call_args_list 
-                               if '_status.json' in str(call)]
-            assert len(status_put_calls) == 1
-            
-            # Verify Step Functions execution was started
-            mock_step.assert_called_once()
-    
-    def test_lambda_handler_invalid_json(self):
-        """Test handling of invalid JSON in S3 object"""
-        event = self.load_fixture('s3_event.json')
-        
-        mock_response = {
-            'Body': MagicMock()
-        }
-        mock_response['Body'].read.return_value = b'invalid json content'
-        
-        with patch('handler.s3_client.get_object') as mock_get_object:
-            mock_get_object.return_value = mock_response
-            
-            result = lambda_handler(event, {})
-            
-            assert result['statusCode'] == 200
-            assert result['body'] == 'success'
-    
-    def test_lambda_handler_s3_error(self):
-        """Test handling of S3 access errors"""
-        event = self.load_fixture('s3_event.json')
-        
-        with patch('handler.s3_client.get_object') as mock_get_object:
-            mock_get_object.side_effect = Exception('S3 access denied')
-            
-            result = lambda_handler(event, {})
-            
-            assert result['statusCode'] == 200
-            assert result['body'] == 'success'
-    
-    def test_lambda_handler_missing_prompt_field(self):
-        """Test handling of JSON without prompt field"""
+
+        mock_aws.get_object.return_value = mock_response
+        # Mock different responses for different calls
+        mock_aws.list_objects_v2.side_effect = [
+            {},  # First call: output directory check (no existing files - no Contents key)
+            mock_list_response  # Second call: input directory file listing
+        ]
+        mock_aws.start_execution.return_value = {'executionArn': 'arn:aws:states:execution'}
+
+        status_puts = self.record_status_puts(mock_aws)
+
+        result = lambda_handler(event, {})
+
+        assert result['statusCode'] == 200
+        assert result['body'] == 'success'
+        mock_aws.get_object.assert_called_once_with(
+            Bucket='test-ai-file-processor-input',
+            Key='test-folder/_prompt.json'
+        )
+
+        # Verify batch input file was uploaded
+        mock_aws.upload_fileobj.assert_called_once()
+        assert mock_aws.upload_fileobj.call_args.args[1:] == ('output-bucket-test', 'test-folder/_batch_input.json')
+
+        # Verify status file was created
+        assert len(status_puts) == 1
+
+        # Verify Step Functions execution was started
+        mock_aws.start_execution.assert_called_once()
+
+    @pytest.mark.parametrize('body, error', [
+        (b'invalid json content', None),
+        (None, Exception('S3 access denied')),
+        (json.dumps({"model": "claude-3-sonnet"}).encode('utf-8'), None),
+    ], ids=['invalid_json', 's3_error', 'missing_prompt_field'])
+    def test_lambda_handler_prompt_errors(self, mock_aws, body, error):
+        """Test handling of unreadable or invalid _prompt.json files"""
         event = self.load_fixture('s3_event.json')
-        
-        invalid_prompt = {"model": "claude-3-sonnet"}
-        mock_response = {
-            'Body': MagicMock()
-        }
-        mock_response['Body'].read.return_value = json.dumps(invalid_prompt).encode('utf-8')
-        
-        with patch('handler.s3_client.get_object') as mock_get_object:
-            mock_get_object.return_value = mock_response
-            
-            result = lambda_handler(event, {})
-            
-            assert result['statusCode'] == 200
-            assert result['body'] == 'success'
-    
-    def test_lambda_handler_duplicate_job_prevention(self):
+
+        if error:
+            mock_aws.get_object.side_effect = error
+        else:
+            mock_aws.get_object.return_value = {'Body': io.BytesIO(body)}
+
+        result = lambda_handler(event, {})
+
+        assert result['statusCode'] == 200
+        assert result['body'] == 'success'
+        mock_aws.start_execution.assert_not_called()
+
+    def test_lambda_handler_duplicate_job_prevention(self, mock_aws):
         """Test handling of duplicate job when output directory already exists"""
         event = self.load_fixture('s3_event.json')
-        sample_prompt = self.load_fixture('sample_prompt.json')
         
-        mock_response = {
-            'Body': MagicMock()
-        }
-        mock_response['Body'].read.return_value = json.dumps(sample_prompt).encode('utf-8')
+        mock_response = {'Body': io.BytesIO(self.load_fixture_bytes('sample_prompt.json'))}
         
         # Mock output bucket to show existing files (job already exists)
         mock_output_list_response = {
@@ -130,87 +135,187 @@ class TestLambdaHandler:
                 {'Key': '_status.json', 'Size': 500}
             ]
         }
-        
-        with patch('handler.s3_client.get_object') as mock_get_object, \
-             patch('handler.s3_client.list_objects_v2') as mock_list, \
-             patch('handler.s3_client.put_object') as mock_put:
-            
-            mock_get_object.return_value = mock_response
-            mock_list.return_value = mock_output_list_response
-            
-            result = lambda_handler(event, {})
-            
-            assert result['statusCode'] == 200
-            assert result['body'] == 'success'
-            
-            # Verify status file was created for duplicate job error
-            error_put_calls = [call for call in mock_put.call_args_list
-                              if 'Job output already exists' in str(call)]
-            assert len(error_put_calls) == 1
-
-    def test_lambda_handler_invalid_directory_depth_root(self):
-        """Test handling of _prompt.json in root directory (too shallow)"""
+
+        mock_aws.get_object.return_value = mock_response
+        mock_aws.list_objects_v2.return_value = mock_output_list_response
+        status_puts = self.record_status_puts(mock_aws)
+
+        result = lambda_handler(event, {})
+
+        assert result['statusCode'] == 200
+        assert result['body'] == 'success'
+
+        # Verify status file was created for duplicate job error
+        error_put_calls = [status for status in status_puts
+                           if 'Job output already exists' in status['message']]
+        assert len(error_put_calls) == 1
+
+    @pytest.mark.parametrize('key', ['_prompt.json', 'folder/subfolder/_prompt.json'], ids=['root', 'nested'])
+    def test_lambda_handler_invalid_directory_depth(self, mock_aws, key):
+        """Test handling of _prompt.json outside a top-level directory"""
         event = {
             "Records": [{
                 "s3": {
                     "bucket": {"name": "test-ai-file-processor-input"},
-                    "object": {"key": "_prompt.json"}
+                    "object": {"key": key}
                 }
             }]
         }
-        sample_prompt = self.load_fixture('sample_prompt.json')
         
-        mock_response = {
-            'Body': MagicMock()
-        }
-        mock_response['Body'].read.return_value = json.dumps(sample_prompt).encode('utf-8')
+        mock_response = {'Body': io.BytesIO(self.load_fixture_bytes('sample_prompt.json'))}
         
-        with patch('handler.s3_client.get_object') as mock_get_object, \
-             patch('handler.s3_client.put_object') as mock_put:
-            
-            mock_get_object.return_value = mock_response
-            
-            result = lambda_handler(event, {})
-            
-            assert result['statusCode'] == 200
-            assert result['body'] == 'success'
-            
-            # Verify error status file was created for invalid directory depth
-            error_put_calls = [call for call in mock_put.call_args_list 
-                              if 'Invalid directory structure' in str(call)]
-            assert len(error_put_calls) == 1
-
-    def test_lambda_handler_invalid_directory_depth_nested(self):
-        """Test handling of _prompt.json in nested directory (too deep)"""
+        mock_aws.get_object.return_value = mock_response
+        status_puts = self.record_status_puts(mock_aws)
+
+        result = lambda_handler(event, {})
+
+        assert result['statusCode'] == 200
+        assert result['body'] == 'success'
+
+        # Verify error status file was created for invalid directory depth
+        error_put_calls = [status for status in status_puts
+                           if 'Invalid directory structure' in status['message']]
+        assert len(error_put_calls) == 1
+
+    def test_lambda_handler_multiple_records(self, mock_aws):
+        """Test that every record in a batched S3 event is processed"""
         event = {
-            "Records": [{
-                "s3": {
-                    "bucket": {"name": "test-ai-file-processor-input"},
-                    "object": {"key": "folder/subfolder/_prompt.json"}
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": "test-ai-file-processor-input"},
+                        "object": {"key": f"folder{i}/subfolder/_prompt.json"}
+                    }
                 }
-            }]
+                for i in range(3)
+            ]
+        }
+
+        mock_aws.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(self.load_fixture_bytes('sample_prompt.json'))
+        }
+
+        result = lambda_handler(event, {})
+
+        assert result['statusCode'] == 200
+        assert mock_aws.get_object.call_count == 3
+
+        status_keys = sorted(call.kwargs['Key'] for call in mock_aws.put_object.call_args_list)
+        assert status_keys == [f'folder{i}/subfolder/_status.json' for i in range(3)]
+
+    def test_lambda_handler_multiple_records_start_executions(self, mock_aws):
+        """Test that each valid record in a batched S3 event starts its own execution"""
+        event = {
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": "test-ai-file-processor-input"},
+                        "object": {"key": f"folder{i}/_prompt.json", "eTag": f"etag{i}"}
+                    }
+                }
+                for i in range(3)
+            ]
+        }
+
+        def list_objects(**kwargs):
+            if kwargs['Bucket'] == 'output-bucket-test':
+                return {}
+            return {'Contents': [{'Key': f"{kwargs['Prefix']}image1.jpg", 'Size': 1024}]}
+
+        mock_aws.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(self.load_fixture_bytes('sample_prompt.json'))
+        }
+        mock_aws.list_objects_v2.side_effect = list_objects
+        mock_aws.start_execution.return_value = {'executionArn': 'arn:aws:states:execution'}
+
+        result = lambda_handler(event, {})
+
+        assert result['statusCode'] == 200
+        directories = sorted(json.loads(call.kwargs['input'])['directory_path'] for call in mock_aws.start_execution.call_args_list)
+        assert directories == ['folder0/', 'folder1/', 'folder2/']
+
+    def test_lambda_handler_caches_prompt_config(self, mock_aws):
+        """Test that an unchanged _prompt.json is only read from S3 once"""
+        event = self.load_fixture('s3_event.json')
+        event['Records'][0]['s3']['object']['key'] = 'folder/subfolder/_prompt.json'
+
+        mock_aws.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(self.load_fixture_bytes('sample_prompt.json'))
         }
+
+        lambda_handler(event, {})
+        lambda_handler(event, {})
+        assert mock_aws.get_object.call_count == 1
+
+        event['Records'][0]['s3']['object']['eTag'] = 'fedcba9876543210fedcba9876543210'
+        lambda_handler(event, {})
+        assert mock_aws.get_object.call_count == 2
+
+    def test_lambda_handler_skips_prompt_cache_without_etag(self, mock_aws):
+        """Test that a _prompt.json from an event without an ETag is read from S3 every time"""
+        event = self.load_fixture('s3_event.json')
+        event['Records'][0]['s3']['object']['key'] = 'folder/subfolder/_prompt.json'
+        del event['Records'][0]['s3']['object']['eTag']
+
+        mock_aws.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(self.load_fixture_bytes('sample_prompt.json'))
+        }
+
+        with patch.object(handler, 'read_prompt_config', wraps=handler.read_prompt_config) as mock_read:
+            lambda_handler(event, {})
+            lambda_handler(event, {})
+
+        assert mock_read.call_count == 2
+        mock_read.assert_called_with('test-ai-file-processor-input', 'folder/subfolder/_prompt.json')
+        assert mock_aws.get_object.call_count == 2
+        # The cached loader is never consulted without an ETag
+        assert load_prompt_config.cache_info().misses == 0
+
+    def test_create_processing_record_id(self):
+        """Test that slashes and dots in the key become dashes in the record id"""
+        file_info = {'key': 'test-folder/scan.page.1.jpg', 'format': 'jpg', 'content_type': 'image'}
         sample_prompt = self.load_fixture('sample_prompt.json')
-        
-        mock_response = {
-            'Body': MagicMock()
+
+        record = create_processing_record(file_info, sample_prompt, 'test-ai-file-processor-input')
+
+        assert record['recordId'] == 'test-folder-scan-page-1-jpg'
+
+    def test_create_batch_file(self):
+        """Test that the batch file is a JSON array of the records"""
+        records = [{'recordId': 'a-jpg', 'prompt': 'caf\u00e9'}, {'recordId': 'b-png'}]
+
+        assert json.loads(create_batch_file(records).read()) == records
+        assert json.loads(create_batch_file([]).read()) == []
+
+
+class TestListFilesInDirectory:
+
+    def test_list_files_in_directory_paginated(self):
+        """Test that files from every list_objects_v2 page are returned"""
+        first_page = {
+            'Contents': [
+                {'Key': 'test-folder/_prompt.json', 'Size': 100},
+                {'Key': 'test-folder/image1.jpg', 'Size': 1024}
+            ],
+            'IsTruncated': True,
+            'NextContinuationToken': 'token-1'
         }
-        mock_response['Body'].read.return_value = json.dumps(sample_prompt).encode('utf-8')
-        
-        with patch('handler.s3_client.get_object') as mock_get_object, \
-             patch('handler.s3_client.put_object') as mock_put:
-            
-            mock_get_object.return_value = mock_response
-            
-            result = lambda_handler(event, {})
-            
-            assert result['statusCode'] == 200
-            assert result['body'] == 'success'
-            
-            # Verify error status file was created for invalid directory depth
-            error_put_calls = [call for call in mock_put.call_args_list 
-                              if 'Invalid directory structure' in str(call)]
-            assert len(error_put_calls) == 1
+        second_page = {
+            'Contents': [
+                {'Key': 'test-folder/image2.png', 'Size': 2048}
+            ],
+            'IsTruncated': False
+        }
+        expected_params = {'Bucket': 'test-ai-file-processor-input', 'Prefix': 'test-folder/', 'MaxKeys': 1000}
+
+        with Stubber(handler.s3_client) as stubber:
+            stubber.add_response('list_objects_v2', first_page, expected_params)
+            stubber.add_response('list_objects_v2', second_page, {**expected_params, 'ContinuationToken': 'token-1'})
+
+            files = list_files_in_directory('test-ai-file-processor-input', 'test-folder/')
+
+            assert [f['key'] for f in files] == ['test-folder/image1.jpg', 'test-folder/image2.png']
+            stubber.assert_no_pending_responses()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,167 @@
+import io
+import json
+import pytest
+from botocore.exceptions import ClientError
+from types import SimpleNamespace
+from unittest.mock import patch, DEFAULT, Mock
+
+from src.status import handler as status_handler
+
+
+def json_body(data):
+    return {'Body': io.BytesIO(json.dumps(data).encode('utf-8'))}
+
+
+@pytest.fixture
+def mock_s3():
+    """Patch the status handler's S3 client methods"""
+    with patch.multiple(status_handler.s3_client, new_callable=Mock, get_object=DEFAULT, put_object=DEFAULT,
+                        head_object=DEFAULT, list_objects_v2=DEFAULT) as s3_mocks:
+        yield SimpleNamespace(**s3_mocks)
+
+
+class TestStatusHandler:
+
+    def written_status(self, mock_s3):
+        return json.loads(mock_s3.put_object.call_args.kwargs['Body'])
+
+    def test_completed_aggregates_map_results(self, mock_s3):
+        """Test that succeeded batches are expanded per file and failed batches count every item as an error"""
+        prefix = '_map_results/batch-001/run-1/'
+        objects = {
+            f'{prefix}manifest.json': {
+                'ResultFiles': {
+                    'SUCCEEDED': [{'Key': f'{prefix}SUCCEEDED_0.json'}],
+                    'FAILED': [{'Key': f'{prefix}FAILED_0.json'}]
+                }
+            },
+            f'{prefix}SUCCEEDED_0.json': [
+                {
+                    'Status': 'SUCCEEDED',
+                    'Output': json.dumps({'statusCode': 200, 'results': [
+                        {'status': 'success', 'input_tokens': 10, 'output_tokens': 20, 'total_tokens': 30},
+                        {'status': 'error', 'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+                    ]})
+                },
+                {
+                    # Single-record worker output, not wrapped in results
+                    'Status': 'SUCCEEDED',
+                    'Output': json.dumps({'status': 'success', 'input_tokens': 5, 'output_tokens': 5, 'total_tokens': 10})
+                }
+            ],
+            f'{prefix}FAILED_0.json': [
+                {'Status': 'FAILED', 'Input': json.dumps({'Items': [{}, {}]})}
+            ]
+        }
+        objects['batch-001/_status.json'] = {'status': 'in_progress', 'total_files': 5, 'completed_files': 0}
+        mock_s3.get_object.side_effect = lambda **kwargs: {**json_body(objects[kwargs['Key']]), 'ETag': '"etag-1"'}
+
+        result = status_handler.lambda_handler({
+            'directory_path': 'batch-001/',
+            'status': 'completed',
+            'message': 'All files processed successfully',
+            'total_files': 5,
+            'model_id': 'model_id',
+            'result_writer_details': {'Bucket': 'output-bucket-test', 'Key': f'{prefix}manifest.json'}
+        }, {})
+
+        assert result['statusCode'] == 200
+        status = self.written_status(mock_s3)
+        assert status['total_files'] == 5
+        assert status['completed_files'] == 5
+        assert status['model_id'] == 'model_id'
+        assert status['successful_files'] == 2
+        assert status['failed_files'] == 3
+        assert status['token_usage']['input_tokens'] == 15
+        assert status['token_usage']['output_tokens'] == 25
+        assert status['token_usage']['total_tokens'] == 40
+        # The write is guarded by the ETag of the status file that was read
+        assert mock_s3.put_object.call_args.kwargs['IfMatch'] == '"etag-1"'
+
+    def test_completed_falls_back_to_output_metadata(self, mock_s3):
+        """Test that token usage is read from output file metadata without ResultWriter details"""
+        mock_s3.list_objects_v2.return_value = {
+            'Contents': [
+                {'Key': 'batch-001/_status.json'},
+                {'Key': 'batch-001/_batch_input.json'},
+                {'Key': 'batch-001/image1.jpg.json'},
+                {'Key': 'batch-001/image2.png.json'}
+            ]
+        }
+        metadata = {
+            'batch-001/image1.jpg.json': {'processing-status': 'success', 'input-tokens': '100',
+                                          'output-tokens': '50', 'total-tokens': '150'},
+            'batch-001/image2.png.json': {'processing-status': 'error', 'input-tokens': '0',
+                                          'output-tokens': '0', 'total-tokens': '0'}
+        }
+        mock_s3.head_object.side_effect = lambda **kwargs: {'Metadata': metadata[kwargs['Key']]}
+        mock_s3.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, 'GetObject'
+        )
+
+        status_handler.lambda_handler({
+            'directory_path': 'batch-001/',
+            'status': 'completed',
+            'message': 'All files processed successfully',
+            'total_files': 2,
+            'model_id': 'model_id'
+        }, {})
+
+        assert mock_s3.list_objects_v2.call_args.kwargs['Delimiter'] == '/'
+        assert sorted(call.kwargs['Key'] for call in mock_s3.head_object.call_args_list) == sorted(metadata)
+        status = self.written_status(mock_s3)
+        # Without a status file to read, the counts come from the event and the write is unconditional
+        assert status['total_files'] == 2
+        assert status['model_id'] == 'model_id'
+        assert 'IfMatch' not in mock_s3.put_object.call_args.kwargs
+        assert status['successful_files'] == 1
+        assert status['failed_files'] == 1
+        assert status['token_usage']['total_tokens'] == 150
+
+    def test_retries_once_when_status_file_changed(self, mock_s3):
+        """Test that a PreconditionFailed write re-reads the status file and retries with its new ETag"""
+        etags = iter(['"etag-1"', '"etag-2"'])
+        mock_s3.get_object.side_effect = lambda **kwargs: {
+            **json_body({'status': 'in_progress', 'total_files': 3, 'completed_files': 0, 'model_id': 'model_id'}),
+            'ETag': next(etags)
+        }
+        mock_s3.put_object.side_effect = [
+            ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'At least one of the pre-conditions you specified did not hold'}}, 'PutObject'),
+            {}
+        ]
+
+        result = status_handler.lambda_handler({
+            'directory_path': 'batch-001/',
+            'status': 'error',
+            'message': 'Processing failed',
+            'total_files': 3,
+            'model_id': 'model_id'
+        }, {})
+
+        assert result['statusCode'] == 200
+        assert [call.kwargs['IfMatch'] for call in mock_s3.put_object.call_args_list] == ['"etag-1"', '"etag-2"']
+        status = self.written_status(mock_s3)
+        assert status['status'] == 'error'
+        assert status['total_files'] == 3
+
+    def test_gives_up_after_second_precondition_failure(self, mock_s3):
+        """Test that a status file changing on every attempt fails the update instead of looping"""
+        mock_s3.get_object.side_effect = lambda **kwargs: {**json_body({'total_files': 3}), 'ETag': '"etag"'}
+        mock_s3.put_object.side_effect = ClientError(
+            {'Error': {'Code': 'PreconditionFailed', 'Message': 'At least one of the pre-conditions you specified did not hold'}},
+            'PutObject'
+        )
+
+        result = status_handler.lambda_handler({
+            'directory_path': 'batch-001/',
+            'status': 'error',
+            'message': 'Processing failed',
+            'total_files': 3
+        }, {})
+
+        assert result['statusCode'] == 500
+        assert mock_s3.put_object.call_count == 2
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,122 @@
+import io
+import json
+import pytest
+from botocore.exceptions import ClientError
+from PIL import Image
+from types import SimpleNamespace
+from unittest.mock import patch, DEFAULT, Mock
+
+from src.worker import handler as worker_handler
+
+
+def image_bytes(image_format, size=(10, 10), mode='RGB'):
+    with io.BytesIO() as output:
+        Image.new(mode, size).save(output, format=image_format)
+        return output.getvalue()
+
+
+@pytest.fixture
+def mock_s3():
+    """Patch the worker's S3 client methods"""
+    with patch.multiple(worker_handler.s3_client, new_callable=Mock, get_object=DEFAULT, put_object=DEFAULT) as s3_mocks:
+        yield SimpleNamespace(**s3_mocks)
+
+
+class TestWorkerHandler:
+
+    def setup_method(self):
+        worker_handler.prepared_file_cache.clear()
+
+    def test_prepared_file_reused_on_not_modified(self, mock_s3):
+        """Test that a 304 from the conditional GET serves the file prepared by an earlier invocation"""
+        mock_s3.get_object.side_effect = [
+            {'Body': io.BytesIO(b'%PDF-1.4 test'), 'ETag': '"etag-1"'},
+            ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        ]
+
+        first = worker_handler.get_prepared_file('input-bucket', 'batch-001/doc.pdf', 'pdf')
+        second = worker_handler.get_prepared_file('input-bucket', 'batch-001/doc.pdf', 'pdf')
+
+        assert first == second == (b'%PDF-1.4 test', 'pdf')
+        assert 'IfNoneMatch' not in mock_s3.get_object.call_args_list[0].kwargs
+        assert mock_s3.get_object.call_args_list[1].kwargs['IfNoneMatch'] == '"etag-1"'
+
+    @pytest.mark.parametrize('image_format, expected_format', [
+        ('PNG', 'png'),
+        ('JPEG', 'jpeg'),
+        ('GIF', 'gif'),
+        ('WEBP', 'webp'),
+    ])
+    def test_convert_and_resize_image_passthrough(self, image_format, expected_format):
+        """Test that small images in a Converse API format are sent unchanged"""
+        file_data = image_bytes(image_format)
+
+        assert worker_handler.convert_and_resize_image(file_data, 'image') == (file_data, expected_format)
+
+    @pytest.mark.parametrize('image_format, size, mode, expected_size', [
+        ('JPEG', (1200, 600), 'RGB', (1000, 500)),
+        ('TIFF', (10, 10), 'CMYK', (10, 10)),
+    ], ids=['oversized', 'unsupported'])
+    def test_convert_and_resize_image_converts(self, image_format, size, mode, expected_size):
+        """Test that oversized or unsupported images are converted to PNG within the max dimension"""
+        output_data, output_format = worker_handler.convert_and_resize_image(
+            image_bytes(image_format, size, mode), 'image'
+        )
+
+        assert output_format == 'png'
+        with Image.open(io.BytesIO(output_data)) as img:
+            assert img.format == 'PNG'
+            assert img.size == expected_size
+            assert img.mode == 'RGB'
+
+    def test_lambda_handler_batch_records(self):
+        """Test that a batched event processes every record and returns results in order"""
+        records = [{'recordId': f'record-{i}', 'file_key': f'batch-001/image{i}.jpg'} for i in range(3)]
+        context = Mock(get_remaining_time_in_millis=Mock(return_value=900 * 1000))
+
+        with patch.object(worker_handler, 'process_record', side_effect=lambda record, bucket: record['recordId']) as mock_process:
+            result = worker_handler.lambda_handler({'records': records, 'output_bucket': 'output-bucket-test'}, context)
+
+        assert result == {'statusCode': 200, 'results': ['record-0', 'record-1', 'record-2']}
+        assert all(call.args[1] == 'output-bucket-test' for call in mock_process.call_args_list)
+
+    def test_lambda_handler_single_record(self):
+        """Test that a single-record event returns that record's result directly"""
+        record = {'recordId': 'record-0', 'file_key': 'batch-001/image0.jpg'}
+
+        with patch.object(worker_handler, 'process_record', return_value={'status': 'success'}) as mock_process:
+            result = worker_handler.lambda_handler({'record': record, 'output_bucket': 'output-bucket-test'}, None)
+
+        assert result == {'status': 'success'}
+        mock_process.assert_called_once_with(record, 'output-bucket-test')
+
+    def test_lambda_handler_batch_out_of_time(self, mock_s3):
+        """Test that records are failed up front once the invocation lacks time for another one"""
+        records = [{'recordId': 'record-0', 'file_key': 'batch-001/image0.jpg', 'bucket': 'input-bucket'}]
+        context = Mock(get_remaining_time_in_millis=Mock(return_value=1000))
+
+        result = worker_handler.lambda_handler({'records': records, 'output_bucket': 'output-bucket-test'}, context)
+
+        assert result['results'][0]['error_code'] == 'TimeBudgetExceeded'
+        mock_s3.get_object.assert_not_called()
+        assert mock_s3.put_object.call_args.kwargs['Key'] == 'batch-001/image0.jpg.json'
+
+    def test_process_record_writes_error_file(self, mock_s3):
+        """Test that a failed record has its error file written before the result is returned"""
+        mock_s3.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, 'GetObject'
+        )
+        record = {'recordId': 'batch-001-doc-pdf', 'file_key': 'batch-001/doc.pdf', 'bucket': 'input-bucket', 'prompt': 'Transcribe'}
+
+        result = worker_handler.process_record(record, 'output-bucket-test')
+
+        assert result['status'] == 'error'
+        assert result['error_code'] == 'NoSuchKey'
+        put_args = mock_s3.put_object.call_args.kwargs
+        assert put_args['Key'] == 'batch-001/doc.pdf.json'
+        assert put_args['Metadata']['processing-status'] == 'error'
+        assert json.loads(put_args['Body'])['error_code'] == 'NoSuchKey'
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])